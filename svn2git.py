@@ -1,12 +1,31 @@
 #! /usr/bin/env python3
 
 import argparse
+import fcntl
+import io
 import os
-import re
+import pathlib
 import shutil
 import subprocess
 import tempfile
+import threading
 import unittest
+import xml.etree.ElementTree as ElementTree
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
+
+
+# Parallel gzip decompressor, used instead of gunzip when available
+PIGZ = shutil.which('pigz')
+
+PIPE_BUFSIZE = 1 << 20
+
+DECOMPRESS_CHUNK_SIZE = 1 << 17
+
+STANDARD_LAYOUT_DIRS = frozenset(('branches/', 'tags/', 'trunk/'))
 
 
 def parse_arguments():
@@ -47,40 +66,133 @@ class TestComeUpWithRepoName(unittest.TestCase):
 
 ################################################################################
 
+def parse_svnlook_tree(tree_output):
+    # The first line is the listed directory itself, its entries are indented by one space
+    return [line[1:] for line in tree_output.splitlines()[1:]]
+
+
+class TestParseSvnlookTree(unittest.TestCase):
+    def test_empty_directory(self):
+        self.assertEqual([], parse_svnlook_tree('/\n'))
+
+    def test_regular_input(self):
+        self.assertEqual(
+            ['branches/', 'tags/', 'trunk/', 'README'],
+            parse_svnlook_tree('/\n branches/\n tags/\n trunk/\n README\n')
+        )
+
+################################################################################
+
+def enlarge_pipe(pipe):
+    # F_SETPIPE_SZ is Linux-only, and the size may exceed /proc/sys/fs/pipe-max-size.
+    # The default pipe size still works, just with more context switches.
+    if not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
+
+    try:
+        fcntl.fcntl(pipe.fileno(), fcntl.F_SETPIPE_SZ, PIPE_BUFSIZE)
+    except OSError:
+        pass
+
+################################################################################
+
 
 class Repository:
     def __init__(self, dump_fname, tmp_dir):
         self.name = come_up_with_repo_name(dump_fname)
         self.abs_path = os.path.join(tmp_dir, self.name)
         self.url = 'file://{}'.format(self.abs_path)
+        self._list_cache = {}
 
         subprocess.check_call(['svnadmin', 'create', self.abs_path])
 
+    def forget_listings(self):
+        self._list_cache.clear()
+
+    def get_authors(self, branch='trunk'):
+        cmdline = ['svn', 'log', '--xml', '--quiet', self.url + '/' + branch]
+        svn = subprocess.Popen(cmdline, stdout=subprocess.PIPE, bufsize=PIPE_BUFSIZE)
+
+        with svn.stdout:
+            authors = parse_svn_log_xml_authors(svn.stdout)
+
+        if svn.wait():
+            raise subprocess.CalledProcessError(svn.returncode, cmdline)
+
+        return authors
+
     def is_standard_layout(self):
-        return sorted(self.list('/')) == 'branches/ tags/ trunk/'.split()
+        return frozenset(self.list('/')) == STANDARD_LAYOUT_DIRS
 
     def list(self, path):
-        return subprocess.check_output(
-            ['svn', 'ls', self.url + '/' + path],
-            encoding='UTF-8'
-        ).splitlines()
+        if path not in self._list_cache:
+            path_arg = [path] if path != '/' else []
+            self._list_cache[path] = parse_svnlook_tree(subprocess.check_output(
+                ['svnlook', 'tree', '--non-recursive', self.abs_path] + path_arg,
+                encoding='UTF-8'
+            ))
+
+        return self._list_cache[path]
 
     def restore_from_dump(self, dump_fname):
-        gunzip = subprocess.Popen(['gunzip', '-c', dump_fname], stdout=subprocess.PIPE)
-        svnadmin = subprocess.Popen(['svnadmin', 'load', '-q', self.abs_path], stdin=gunzip.stdout)
-        svnadmin.communicate()
+        if igzip:
+            self._load_decompressed_in_process(dump_fname)
+        else:
+            self._load_decompressed_by_subprocess(dump_fname)
+
+    def _load_cmdline(self):
+        # The dump is loaded into a scratch repository, so there is no need to fsync every revision
+        return [
+            'svnadmin', 'load', '-q', '--bypass-prop-validation', '--no-flush-to-disk',
+            self.abs_path
+        ]
+
+    def _load_decompressed_in_process(self, dump_fname):
+        cmdline = self._load_cmdline()
+        try:
+            # Leaving the block closes svnadmin's stdin and waits for it to exit
+            with subprocess.Popen(cmdline, stdin=subprocess.PIPE, bufsize=PIPE_BUFSIZE) as svnadmin:
+                with igzip.open(dump_fname, 'rb') as f:
+                    while chunk := f.read(DECOMPRESS_CHUNK_SIZE):
+                        svnadmin.stdin.write(chunk)
+        except BrokenPipeError:
+            # svnadmin has exited early, its exit status tells why
+            pass
+
+        if svnadmin.returncode:
+            raise subprocess.CalledProcessError(svnadmin.returncode, cmdline)
+
+    def _load_decompressed_by_subprocess(self, dump_fname):
+        decompress_cmd = [PIGZ, '-dc'] if PIGZ else ['gunzip', '-c']
+        gunzip = subprocess.Popen(decompress_cmd + [dump_fname], stdout=subprocess.PIPE)
+        enlarge_pipe(gunzip.stdout)
+        svnadmin = subprocess.Popen(self._load_cmdline(), stdin=gunzip.stdout)
+
+        # Let the decompressor get SIGPIPE if svnadmin exits early
+        gunzip.stdout.close()
+
+        svnadmin.wait()
+        gunzip.wait()
+
+        # Check svnadmin first: if it fails, the decompressor is merely killed by SIGPIPE
+        for process in (svnadmin, gunzip):
+            if process.returncode:
+                raise subprocess.CalledProcessError(process.returncode, process.args)
 
 
 ################################################################################
 
 def parse_author(author_xml):
     author_tag = '<author>'
-    if not author_xml.startswith(author_tag):
+    head, sep, tail = author_xml.partition(author_tag)
+    if head or not sep:
         raise ValueError('Not an {} element'.format(author_tag))
 
-    v = author_xml[len(author_tag):]
-    bracket_pos = v.index('<')
-    return v[:bracket_pos]
+    name, bracket, _ = tail.partition('<')
+    if not bracket:
+        raise ValueError('Unterminated {} element'.format(author_tag))
+
+    return name
 
 
 class TestParseAuthor(unittest.TestCase):
@@ -91,47 +203,117 @@ class TestParseAuthor(unittest.TestCase):
     def test_regular_input(self):
         self.assertEqual('me', parse_author('<author>me</author>'))
 
+    def test_unterminated_element(self):
+        with self.assertRaises(ValueError):
+            parse_author('<author>me')
+
 ################################################################################
 
-def parse_svn_log_authors(log_output):
-    log_lines = log_output.split('\n')
-    return sorted(list(set([parse_author(s) for s in log_lines if s.startswith('<author>')])))
+def parse_svn_log_xml_authors(log_stream):
+    authors = set()
+    events = ElementTree.iterparse(log_stream, events=('start', 'end'))
+    _, root = next(events)
+    for event, elem in events:
+        if event != 'end':
+            continue
+
+        if elem.tag == 'author':
+            # svn:author can be set to an empty string
+            if elem.text:
+                authors.add(elem.text)
+        elif elem.tag == 'logentry':
+            # Drop the parsed entries so that the log is never held in memory as a whole
+            root.clear()
+
+    return sorted(authors)
 
 
-class TestGetAuthors(unittest.TestCase):
+class TestParseSvnLogXmlAuthors(unittest.TestCase):
+    def parse_log_entries(self, entries_xml):
+        log_xml = '<?xml version="1.0" encoding="UTF-8"?>\n<log>{}</log>\n'.format(entries_xml)
+        return parse_svn_log_xml_authors(io.BytesIO(log_xml.encode('UTF-8')))
+
     def test_empty_input(self):
-        self.assertEqual([], parse_svn_log_authors(''))
+        self.assertEqual([], self.parse_log_entries(''))
 
     def test_regular_input(self):
-        log_output = """
+        log_entries = """
+<logentry revision="2">
 <author>gli</author>
 <date>2006-10-19T19:42:33.061832Z</date>
+</logentry>
+<logentry revision="1">
 <author>xyz</author>
 <date>2006-10-16T20:09:08.871296Z</date>
+</logentry>
         """
-        self.assertEqual(['gli', 'xyz'], parse_svn_log_authors(log_output))
+        self.assertEqual(['gli', 'xyz'], self.parse_log_entries(log_entries))
 
     def test_repeating_authors(self):
-        log_output = """
+        log_entries = """
+<logentry revision="2">
 <author>gli</author>
 <date>2006-10-19T19:42:33.061832Z</date>
+</logentry>
+<logentry revision="1">
 <author>gli</author>
 <date>2006-10-16T20:09:08.871296Z</date>
+</logentry>
         """
-        self.assertEqual(['gli'], parse_svn_log_authors(log_output))
+        self.assertEqual(['gli'], self.parse_log_entries(log_entries))
 
     def test_output_is_sorted(self):
-        log_output = """
+        log_entries = """
+<logentry revision="3">
 <author>q</author>
 <date>2006-10-19T19:42:33.061832Z</date>
+</logentry>
+<logentry revision="2">
 <author>a</author>
 <date>2006-10-16T20:09:08.871296Z</date>
+</logentry>
+<logentry revision="1">
 <author>z</author>
 <date>2006-10-16T20:09:08.871296Z</date>
+</logentry>
         """
-        self.assertEqual(['a', 'q', 'z'], parse_svn_log_authors(log_output))
+        self.assertEqual(['a', 'q', 'z'], self.parse_log_entries(log_entries))
         # TODO: test the order
 
+    def test_entry_without_author(self):
+        log_entries = """
+<logentry revision="1">
+<author>gli</author>
+<date>2006-10-16T20:09:08.871296Z</date>
+</logentry>
+<logentry revision="0">
+<date>2006-10-16T20:00:00.000000Z</date>
+</logentry>
+        """
+        self.assertEqual(['gli'], self.parse_log_entries(log_entries))
+
+    def test_empty_author(self):
+        log_entries = """
+<logentry revision="2">
+<author></author>
+<date>2006-10-19T19:42:33.061832Z</date>
+</logentry>
+<logentry revision="1">
+<author>gli</author>
+<date>2006-10-16T20:09:08.871296Z</date>
+</logentry>
+        """
+        self.assertEqual(['gli'], self.parse_log_entries(log_entries))
+
+    def test_escaped_author(self):
+        log_entries = """
+<logentry revision="1">
+<author>a&amp;b</author>
+<date>2006-10-16T20:09:08.871296Z</date>
+</logentry>
+        """
+        self.assertEqual(['a&b'], self.parse_log_entries(log_entries))
+
 
 ################################################################################
 
@@ -143,22 +325,22 @@ class WorkingCopy:
             ['svn', 'co', '-q', 'file://{}/{}'.format(repo.abs_path, branch), self.abs_path]
         )
 
-    def get_authors(self):
-        log_output = subprocess.check_output(
-            ['svn', 'log', '--xml', '--quiet', self.abs_path],
-            encoding='UTF-8'
-        )
-        return parse_svn_log_authors(log_output)
-
 ################################################################################
 
 def extract_keys_from_prompt(prompt):
-    p = re.compile('\[.\]')
-    matches = re.findall(p, prompt)
-    if not matches:
+    keys = []
+    i = 0
+    while i < len(prompt) - 2:
+        if prompt[i] == '[' and prompt[i + 2] == ']':
+            keys.append(prompt[i + 1])
+            i += 3
+        else:
+            i += 1
+
+    if not keys:
         raise ValueError('No menu items defined')
 
-    return ''.join([m[1] for m in matches])
+    return ''.join(keys)
 
 
 class TestExtractKeysFromPrompt(unittest.TestCase):
@@ -169,18 +351,34 @@ class TestExtractKeysFromPrompt(unittest.TestCase):
     def test_with_keys(self):
         self.assertEqual('ac', extract_keys_from_prompt('Type [a] to abort, [c] to continue'))
 
+    def test_keys_at_edges(self):
+        self.assertEqual('xy', extract_keys_from_prompt('[x]or[y]'))
+
+    def test_brackets_without_single_key(self):
+        with self.assertRaises(ValueError):
+            extract_keys_from_prompt('[] and [ab]')
+
 ################################################################################
 
 def prompt_menu(prompt):
-    choices = extract_keys_from_prompt(prompt).lower()
+    choices = frozenset(extract_keys_from_prompt(prompt).lower())
 
     while True:
-        choice = input(prompt + ' > ').lower()
-        if len(choice) == 1 and (choice in choices):
+        choice = input(prompt + ' > ').strip().lower()
+        if choice in choices:
             return choice
 
 ################################################################################
 
+def remove_tree_in_background(path):
+    # Renaming frees the path right away, the files are deleted while the conversion runs
+    staging_path = '{}.trash.{}'.format(path, os.getpid())
+    os.rename(path, staging_path)
+    threading.Thread(
+        target=shutil.rmtree, args=(staging_path,), kwargs={'ignore_errors': True}, daemon=True
+    ).start()
+
+
 def ensure_standard_repo_layout(tmp_dir, repo):
     full_wc = None
 
@@ -197,28 +395,77 @@ def ensure_standard_repo_layout(tmp_dir, repo):
 
         choice = prompt_menu('Type [c] to continue when done...')
 
+        # The layout has presumably been changed, so list the repository again
+        repo.forget_listings()
+
     if full_wc:
-        shutil.rmtree(full_wc.abs_path)
+        remove_tree_in_background(full_wc.abs_path)
 
 
 ################################################################################
 
 class AuthorsFile:
     def __init__(self, tmp_dir, repo, domain):
-        wc = WorkingCopy(tmp_dir, repo, 'trunk')
-        authors = wc.get_authors()
-        shutil.rmtree(wc.abs_path)
+        authors = repo.get_authors()
 
         self.abs_path = os.path.join(tmp_dir, 'authors.txt')
+        self._path = pathlib.Path(self.abs_path)
 
-        with open(self.abs_path, 'w') as f:
-            f.write(''.join([
-                '{author} = {author} <{author}@{domain}>\n'.format(author=a, domain=domain)
-                for a in authors
-            ]))
+        with self._path.open('w', encoding='UTF-8') as f:
+            f.writelines(f'{a} = {a} <{a}@{domain}>\n' for a in authors)
+
+        self._content = None
 
     def read(self):
-        return open(self.abs_path).read()
+        if self._content is None:
+            self.reload()
+
+        return self._content
+
+    def reload(self):
+        self._content = self._path.read_text(encoding='UTF-8')
+
+################################################################################
+
+REMOTE_REF_PREFIXES = ('refs/remotes/tags/', 'refs/remotes/')
+
+
+def partition_remote_refs(for_each_ref_output):
+    refs = {prefix: [] for prefix in REMOTE_REF_PREFIXES}
+    for refname in for_each_ref_output.splitlines():
+        prefix = next(p for p in REMOTE_REF_PREFIXES if refname.startswith(p))
+        refs[prefix].append(refname[len(prefix):])
+
+    return refs
+
+
+class TestPartitionRemoteRefs(unittest.TestCase):
+    def test_empty_input(self):
+        self.assertEqual(
+            {'refs/remotes/tags/': [], 'refs/remotes/': []},
+            partition_remote_refs('')
+        )
+
+    def test_regular_input(self):
+        output = (
+            'refs/remotes/tags/v1\n'
+            'refs/remotes/trunk\n'
+            'refs/remotes/feature@12\n'
+        )
+        self.assertEqual(
+            {
+                'refs/remotes/tags/': ['v1'],
+                'refs/remotes/': ['trunk', 'feature@12']
+            },
+            partition_remote_refs(output)
+        )
+
+    def test_name_clashing_with_local_branch(self):
+        # git shortens this one to 'remotes/master' because of refs/heads/master
+        self.assertEqual(
+            {'refs/remotes/tags/': [], 'refs/remotes/': ['master']},
+            partition_remote_refs('refs/remotes/master\n')
+        )
 
 ################################################################################
 
@@ -227,22 +474,23 @@ class GitRepo:
     def __init__(self, tmp_dir):
         self.abs_path = os.path.join(tmp_dir, 'git')
 
-    def branch(self, name, what):
-        subprocess.check_call(['git', 'branch', name, what], cwd=self.abs_path)
+    def apply_ref_updates(self, updates):
+        cmdline = ['git', 'update-ref', '-z', '--stdin']
+        git = subprocess.Popen(cmdline, stdin=subprocess.PIPE, cwd=self.abs_path)
 
-    def delete_branch(self, branch, remote=False):
-        remote_arg = ['-r'] if remote else []
-        subprocess.check_call(['git', 'branch', '-D'] + remote_arg + [branch], cwd=self.abs_path)
+        with git.stdin:
+            for command, ref, value in updates:
+                git.stdin.write('{} {}\0{}\0'.format(command, ref, value).encode('UTF-8'))
 
-    def get_short_refs(self, refs=None):
-        cmdline = ['git', 'for-each-ref', '--format=%(refname:short)']
-        if refs:
-            cmdline.append(refs)
+        if git.wait():
+            raise subprocess.CalledProcessError(git.returncode, cmdline)
 
-        return subprocess.check_output(cmdline, cwd=self.abs_path, encoding='UTF-8').splitlines()
-
-    def tag(self, tag_name, what):
-        subprocess.check_call(['git', 'tag', tag_name, what], cwd=self.abs_path)
+    def get_remote_refs(self):
+        return partition_remote_refs(subprocess.check_output(
+            ['git', 'for-each-ref', '--format=%(refname)', 'refs/remotes/'],
+            cwd=self.abs_path,
+            encoding='UTF-8'
+        ))
 
 ################################################################################
 
@@ -256,6 +504,7 @@ def generate_authors_file(tmp_dir, repo):
 
         if choice == 'e':
             subprocess.check_call([os.environ['EDITOR'], authors_file.abs_path])
+            authors_file.reload()
         elif choice == 'p':
             break
         elif choice == 'v':
@@ -265,18 +514,49 @@ def generate_authors_file(tmp_dir, repo):
 
 
 def convert_svn_to_git(authors_file, git, repo):
+    # The repository is written from scratch and can be recreated, so skip fsync and auto gc.
+    # 'git -c' settings are passed down to the git commands that git svn runs.
     subprocess.check_call([
-        'git', 'svn', 'clone', repo.url, '--authors-file={}'.format(authors_file.abs_path),
+        'git', '-c', 'core.fsync=none', '-c', 'gc.auto=0',
+        'svn', 'clone', repo.url, '--authors-file={}'.format(authors_file.abs_path),
         '--no-metadata', '--prefix', '', '-s', git
     ])
 
 
-def fix_tag_name(tag):
-    tag_prefix = 'tags/'
-    if tag.startswith(tag_prefix):
-        return tag[len(tag_prefix):]
-    else:
-        return tag
+def generate_ref_updates(refs):
+    for tag in refs['refs/remotes/tags/']:
+        yield 'create', 'refs/tags/' + tag, 'refs/remotes/tags/' + tag
+        yield 'delete', 'refs/remotes/tags/' + tag, ''
+
+    for branch in refs['refs/remotes/']:
+        # Branches with '@' in the name are older incarnations of the branch, drop them.
+        # Trunk is already checked out as master.
+        if '@' not in branch and branch != 'trunk':
+            yield 'create', 'refs/heads/' + branch, 'refs/remotes/' + branch
+        yield 'delete', 'refs/remotes/' + branch, ''
+
+
+class TestGenerateRefUpdates(unittest.TestCase):
+    def test_no_refs(self):
+        refs = {'refs/remotes/tags/': [], 'refs/remotes/': []}
+        self.assertEqual([], list(generate_ref_updates(refs)))
+
+    def test_regular_input(self):
+        refs = {
+            'refs/remotes/tags/': ['v1'],
+            'refs/remotes/': ['trunk', 'feature', 'feature@12']
+        }
+        self.assertEqual(
+            [
+                ('create', 'refs/tags/v1', 'refs/remotes/tags/v1'),
+                ('delete', 'refs/remotes/tags/v1', ''),
+                ('delete', 'refs/remotes/trunk', ''),
+                ('create', 'refs/heads/feature', 'refs/remotes/feature'),
+                ('delete', 'refs/remotes/feature', ''),
+                ('delete', 'refs/remotes/feature@12', ''),
+            ],
+            list(generate_ref_updates(refs))
+        )
 
 
 def main():
@@ -302,19 +582,7 @@ def main():
     print('Converting to GIT repository at {}'.format(git_repo.abs_path))
     convert_svn_to_git(authors_file, git_repo.abs_path, repo)
 
-    for tag in git_repo.get_short_refs('refs/remotes/tags'):
-        git_repo.tag(fix_tag_name(tag), tag)
-        git_repo.delete_branch(tag, remote=True)
-
-    for branch in git_repo.get_short_refs('refs/remotes'):
-        git_repo.branch(branch, 'refs/remotes/' + branch)
-        git_repo.delete_branch(branch, remote=True)
-
-    for branch in git_repo.get_short_refs():
-        if '@' in branch:
-            git_repo.delete_branch(branch, remote=True)
-
-    git_repo.delete_branch('trunk', remote=False)
+    git_repo.apply_ref_updates(generate_ref_updates(git_repo.get_remote_refs()))
 
     print(tmp_dir)
 